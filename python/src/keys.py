@@ -7,6 +7,7 @@ params = {p["Name"].split("/")[-1]: p["Value"] for p in res["Parameters"]}
 
 CONSUMER_KEY = params["CONSUMER_KEY"]
 CONSUMER_SECRET = params["CONSUMER_SECRET"]
+CONSUMER_SECRET_BYTES = CONSUMER_SECRET.encode("utf-8")
 OPENAI_API_KEY = params["OPENAI_API_KEY"]
 APP_BEARER_TOKEN = params["APP_BEARER_TOKEN"]
 OAUTH1_BOT_ACCESS_TOKEN = params["OAUTH1_BOT_ACCESS_TOKEN"]
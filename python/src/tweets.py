@@ -1,11 +1,17 @@
+import asyncio
+import itertools
 import os
-import time
+import random
+from collections import defaultdict
 from datetime import datetime, timedelta, timezone
-from typing import Any
+from typing import Any, Optional
 
+import aiohttp
 import openai
 import tweepy
+from async_lru import alru_cache
 from aws_lambda_powertools.logging import Logger
+from tweepy.asynchronous import AsyncClient
 
 from keys import (
     APP_BEARER_TOKEN,
@@ -15,20 +21,33 @@ from keys import (
     OAUTH1_BOT_TOKEN_SECRET,
     OPENAI_API_KEY,
 )
-from utils import build_tweet_tree, enumerate_tweet_tree, get_parent
+from utils import enumerate_tweet_tree
 
 openai.api_key = OPENAI_API_KEY
 BOT_USER_ID = int(os.environ["BOT_USER_ID"])
 
+SUMMARY_PROMPT_SUFFIX = (
+    "\nSummarize the above into a single 280 character Tweet:\n<tweet>"
+)
+
+# Backoff parameters (in seconds) for waiting on the search API to index a thread.
+# The total wait leaves time within the 30 second Lambda timeout for the summary
+# and the reply.
+SEARCH_INITIAL_DELAY = 1.0
+SEARCH_MAX_DELAY = 8.0
+SEARCH_MAX_WAIT = 10.0
+
 logger = Logger(service="twitter-webhook", child=True)
 
-tw_client = tweepy.Client(
+tw_client = AsyncClient(
     bearer_token=APP_BEARER_TOKEN,
     consumer_key=CONSUMER_KEY,
     consumer_secret=CONSUMER_SECRET,
     access_token=OAUTH1_BOT_ACCESS_TOKEN,
     access_token_secret=OAUTH1_BOT_TOKEN_SECRET,
 )
+# Created by client_session() on first use, since it needs a running event loop
+http_session: Optional[aiohttp.ClientSession] = None
 
 
 class TweetTooOldError(Exception):
@@ -47,6 +66,34 @@ class CannotAccessTweetError(Exception):
     """Exception raised when a tweet is not accessible."""
 
 
+async def client_session() -> aiohttp.ClientSession:
+    """Get the HTTP session shared by the Twitter and OpenAI clients.
+
+    The session is created on first use and then kept open, so that connections
+    opened in one invocation are reused by the next while the container is warm.
+    It is bound to the event loop it was created on, so it must always be used
+    from the same loop.
+
+    Returns
+    -------
+    aiohttp.ClientSession
+        The shared session.
+    """
+
+    global http_session
+    if http_session is None or http_session.closed:
+        # Expire idle connections after 30 seconds, so that a connection left idle
+        # while the container was frozen is replaced rather than reused after the
+        # server may have closed it.
+        connector = aiohttp.TCPConnector(keepalive_timeout=30)
+        http_session = aiohttp.ClientSession(connector=connector)
+        tw_client.session = http_session
+    # openai reads the session from a context variable, which only applies to the
+    # current task and those it starts
+    openai.aiosession.set(http_session)
+    return http_session
+
+
 def handle_errors(errors: list[dict[str, Any]]):
     error = errors[0]
     if error["type"] == "https://api.twitter.com/2/problems/resource-not-found":
@@ -59,7 +106,7 @@ def handle_errors(errors: list[dict[str, Any]]):
     raise RuntimeError(f"Error from Twitter API: {error}")
 
 
-def get_conversation_id(tweet_id: int) -> int:
+async def get_conversation_id(tweet_id: int) -> tuple[int, Optional[tweepy.Tweet]]:
     """Get the conversation ID of the tagging tweet.
 
     Args
@@ -69,13 +116,21 @@ def get_conversation_id(tweet_id: int) -> int:
 
     Returns
     -------
-    Optional[int]
-        The conversation ID of the tweet, or None if the tweet doesn't exist.
+    tuple[int, Optional[tweepy.Tweet]]
+        The conversation ID of the tweet, and the tweet that started the
+        conversation if it was one of the tweets referenced by the tagging tweet.
     """
 
-    resp = tw_client.get_tweet(
+    # Request the start tweet fields as well, so that the referenced tweets can be
+    # used as the start tweet without looking it up again.
+    resp = await tw_client.get_tweet(
         tweet_id,
-        tweet_fields=["conversation_id", "referenced_tweets"],
+        tweet_fields=[
+            "conversation_id",
+            "referenced_tweets",
+            "author_id",
+            "created_at",
+        ],
         expansions=["referenced_tweets.id"],
     )
     tweet: tweepy.Tweet = resp.data
@@ -83,17 +138,42 @@ def get_conversation_id(tweet_id: int) -> int:
         handle_errors(resp.errors)
     logger.debug("Tagging tweet: %s", tweet)
 
-    if tweet.referenced_tweets:
-        for ref in tweet.referenced_tweets:
-            if ref.type == "quoted":  # Tagging tweet is a quote tweet
-                qt: tweepy.Tweet
-                for qt in resp.includes["tweets"]:
-                    if qt.id == ref.id:
-                        return qt.conversation_id
-    return tweet.conversation_id
+    included: list[tweepy.Tweet] = resp.includes.get("tweets", [])
+    conv_id = tweet.conversation_id
+    for ref in tweet.referenced_tweets or []:
+        if ref.type == "quoted":  # Tagging tweet is a quote tweet
+            qt = next((x for x in included if x.id == ref.id), None)
+            if qt is not None:
+                conv_id = qt.conversation_id
+                break
+
+    start_tweet = next((x for x in included if x.id == conv_id), None)
+    return conv_id, start_tweet
+
+
+@alru_cache(maxsize=1024, ttl=600)
+async def get_start_tweet(conv_id: int) -> tweepy.Tweet:
+    """Get the first tweet of a conversation.
+
+    Args
+    ----
+    conv_id: int
+        The ID of the conversation.
+
+    Returns
+    -------
+    tweepy.Tweet
+        The tweet that started the conversation.
+    """
+
+    resp = await tw_client.get_tweet(conv_id, tweet_fields=["author_id,created_at"])
+    if resp.errors:
+        handle_errors(resp.errors)
+    logger.debug("Thread start tweet: %s", resp.data)
+    return resp.data
 
 
-def get_thread_tweets(conv_id: int, author_id: int) -> tweepy.Response:
+async def get_thread_tweets(conv_id: int, author_id: int) -> tweepy.Response:
     """Get the tweets in a thread.
 
     Args
@@ -112,8 +192,8 @@ def get_thread_tweets(conv_id: int, author_id: int) -> tweepy.Response:
     end_time = datetime.utcnow() - timedelta(seconds=10)
     end_time_str = end_time.isoformat("T", timespec="seconds") + "Z"
 
-    def _get_tweets() -> tweepy.Response:
-        return tw_client.search_recent_tweets(
+    async def _get_tweets() -> tweepy.Response:
+        return await tw_client.search_recent_tweets(
             f"from:{author_id} to:{author_id} conversation_id:{conv_id}",
             max_results=100,
             tweet_fields=["referenced_tweets", "conversation_id", "author_id"],
@@ -121,12 +201,23 @@ def get_thread_tweets(conv_id: int, author_id: int) -> tweepy.Response:
             end_time=end_time_str,
         )
 
-    while (resp := _get_tweets()).meta["result_count"] == 0:
-        time.sleep(3)  # Wait for API to catch up
+    # Wait for API to catch up, backing off exponentially with jitter. Give up
+    # eventually, since a thread without any replies will never return results.
+    delay = SEARCH_INITIAL_DELAY
+    waited = 0.0
+    while (resp := await _get_tweets()).meta["result_count"] == 0:
+        if waited >= SEARCH_MAX_WAIT:
+            logger.warning("No thread tweets found after %.1f seconds", waited)
+            break
+        sleep_for = min(delay, SEARCH_MAX_DELAY) * random.uniform(0.75, 1.25)
+        sleep_for = min(sleep_for, SEARCH_MAX_WAIT - waited)
+        await asyncio.sleep(sleep_for)
+        waited += sleep_for
+        delay *= 2
     return resp
 
 
-def get_gpt_summary(thread: list[str]) -> str:
+async def get_gpt_summary(thread: list[str]) -> str:
     """Get a summary of a thread using GPT-3.
 
     Args
@@ -139,22 +230,23 @@ def get_gpt_summary(thread: list[str]) -> str:
     str
         The summary of the thread.
     """
-    prompt = "<tweet>" + "</tweet><tweet>".join(thread) + "</tweet>"
-    prompt = (
-        f"{prompt}\nSummarize the above into a single 280 character Tweet:\n<tweet>"
-    )
-    summary = (
-        openai.Completion.create(
-            model="text-davinci-003",
-            prompt=prompt,
-            temperature=0.7,
-            max_tokens=70,
-            stop="</tweet>",
-        )
-        .choices[0]
-        .text.strip()
+    prompt = "".join(f"<tweet>{t}</tweet>" for t in thread) + SUMMARY_PROMPT_SUFFIX
+    chunks = await openai.Completion.acreate(
+        model="text-davinci-003",
+        prompt=prompt,
+        temperature=0.7,
+        max_tokens=70,
+        stop="</tweet>",
+        stream=True,
     )
-    return summary
+    summary = ""
+    # Anything beyond a full tweet would be truncated anyway, so stop reading early.
+    # The unread response is released once the stream is garbage collected.
+    async for chunk in chunks:
+        summary += chunk.choices[0].text
+        if len(summary.strip()) > 280:
+            break
+    return summary.strip()
 
 
 def limit_summary(summary: str) -> str:
@@ -173,41 +265,36 @@ def limit_summary(summary: str) -> str:
     if len(summary) <= 280:
         return summary
 
-    removed = 0
-    words = summary.split()
-    for i in range(len(words) - 1, 0, -1):
-        removed += len(words[i]) + 1
-        if len(summary) - removed <= 280:
-            summary = " ".join(words[:i])[:280]
-            break
-    return summary
+    # Cut at the last space that keeps whole words within the limit
+    cut = summary.rfind(" ", 0, 281)
+    return summary[:cut] if cut > 0 else summary[:280]
 
 
 class TweetHandler:
     def __init__(self, tweet: dict[str, Any]) -> None:
         self.tweet = tweet
-        self.conv_id = get_conversation_id(tweet["id"])
 
-    def handle(self) -> bool:
+    async def handle(self) -> bool:
+        self.conv_id, self.start_tweet = await get_conversation_id(self.tweet["id"])
         try:
-            thread = self.get_tweet_thread()
-            logger.info(f"Thread:\n\n{thread}")
-            summary = get_gpt_summary(thread)
-            logger.info(f"GPT summary:\n\n{summary}")
+            thread = await self.get_tweet_thread()
+            logger.info("Thread:\n\n%s", thread)
+            summary = await get_gpt_summary(thread)
+            logger.info("GPT summary:\n\n%s", summary)
             summary = limit_summary(summary)
         except TweetTooOldError as e:
             logger.info(e)
-            self.reply_to_tweet(
+            await self.reply_to_tweet(
                 "I'm sorry but I can't analyse threads older than 7 days"
             )
             return False
         except TweetNotFoundError as e:
             logger.info(e)
-            self.reply_to_tweet("I'm sorry but I can't find that tweet")
+            await self.reply_to_tweet("I'm sorry but I can't find that tweet")
             return False
         except CannotAccessTweetError as e:
             logger.info(e)
-            self.reply_to_tweet("I'm sorry but I can't access that tweet")
+            await self.reply_to_tweet("I'm sorry but I can't access that tweet")
             return False
         except InvalidTaggingTweetError as e:
             logger.info(e)
@@ -215,56 +302,76 @@ class TweetHandler:
             # triggered by replies below the bot
             return False
         except Exception as e:
-            logger.exception(f"Error getting tweet thread: {e}")
+            logger.exception("Error getting tweet thread: %s", e)
             return False
 
-        self.reply_to_tweet(summary)
+        await self.reply_to_tweet(summary)
         return True
 
-    def reply_to_tweet(self, summary: str) -> None:
-        logger.info(f"Replying to tweet {self.tweet['id']} with {summary}")
+    async def reply_to_tweet(self, summary: str) -> None:
+        logger.info("Replying to tweet %s with %s", self.tweet["id"], summary)
         if os.environ.get("DEBUG", "0") == "1":
             return
-        tw_client.create_tweet(
+        await tw_client.create_tweet(
             text=summary,
             in_reply_to_tweet_id=self.tweet["id"],
             exclude_reply_user_ids=[BOT_USER_ID, self.thread_author],
         )
 
-    def get_tweet_thread(self) -> list[str]:
-        resp = tw_client.get_tweet(self.conv_id, tweet_fields=["author_id,created_at"])
-        if resp.errors:
-            handle_errors(resp.errors)
-
-        tweet: tweepy.Tweet
-        tweet = resp.data
-        logger.debug("Thread start tweet: %s", tweet)
-
-        self.thread_author = tweet.author_id
-        text = tweet.text
-
-        if self.thread_author != self.tweet["in_reply_to_user_id"]:
-            raise InvalidTaggingTweetError("Tweet is not a reply to the thread author")
-        if tweet.created_at < datetime.now(timezone.utc) - timedelta(days=7):
-            raise TweetTooOldError("Tweet is older than 7 days")
-
-        data = get_thread_tweets(self.conv_id, self.thread_author)
+    async def get_tweet_thread(self) -> list[str]:
+        # The thread author has to be the user being replied to, so the search
+        # for the thread tweets can run while the start tweet is fetched. Replies to
+        # the bot and tweets that aren't replies will fail validation, so don't
+        # spend a search request on them.
+        reply_to: Optional[int] = self.tweet.get("in_reply_to_user_id")
+        search: Optional[asyncio.Task] = None
+        if self.start_tweet is None and reply_to not in (None, BOT_USER_ID):
+            search = asyncio.create_task(get_thread_tweets(self.conv_id, reply_to))
+        try:
+            tweet = self.start_tweet or await get_start_tweet(self.conv_id)
+            self.thread_author = tweet.author_id
+            text = tweet.text
+
+            if self.thread_author != reply_to:
+                raise InvalidTaggingTweetError(
+                    "Tweet is not a reply to the thread author"
+                )
+            if tweet.created_at < datetime.now(timezone.utc) - timedelta(days=7):
+                raise TweetTooOldError("Tweet is older than 7 days")
+        except BaseException:
+            if search is not None and not search.cancel() and not search.cancelled():
+                # The search has already finished, so retrieve any error it raised
+                # to stop it being reported as never retrieved
+                search.exception()
+            raise
+
+        if search is not None:
+            data = await search
+        else:
+            data = await get_thread_tweets(self.conv_id, self.thread_author)
         logger.debug("Tweet thread data: %s", data.data)
 
         # Need to get the included tweets, since sometimes the API doesn't return all
         # the tweets
         tweets: dict[int, str] = {self.conv_id: text}
-        parents: dict[int, int] = {}
-        for tweet in data.includes["tweets"] + data.data:
+        tree: dict[int, list[int]] = defaultdict(list)
+        seen: set[int] = set()
+        for tweet in itertools.chain(data.includes.get("tweets", []), data.data or []):
+            # Referenced tweets can also be in the search results
+            if tweet.id in seen:
+                continue
+            seen.add(tweet.id)
+
             if (
                 tweet.author_id == self.thread_author
                 and tweet.conversation_id == self.conv_id
             ):
                 tweets[tweet.id] = tweet.text
-            if (p := get_parent(tweet)) is not None:
-                parents[tweet.id] = p
+            for ref in tweet.referenced_tweets or []:
+                if ref.type == "replied_to":
+                    tree[ref.id].append(tweet.id)
+                    break
 
-        tree = build_tweet_tree(parents)
         logger.debug("Tweet tree: %s", tree)
 
         # We need to ignore the tagging tweet, in case we're tagged by the thread
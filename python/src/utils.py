@@ -1,27 +1,3 @@
-from collections import defaultdict
-from typing import Any, Optional
-
-
-def build_tweet_tree(parents: dict[int, int]) -> dict[int, list[int]]:
-    """Build a tree of tweets.
-
-    Args
-    ----
-    parents: dict[int, int]
-        A dictionary mapping tweet IDs to their parent IDs.
-
-    Returns
-    -------
-    dict[int, list[int]]
-        A dictionary mapping tweet IDs to a list of their children.
-    """
-
-    tree = defaultdict(list)
-    for child, parent in parents.items():
-        tree[parent].append(child)
-    return tree
-
-
 def enumerate_tweet_tree(tree: dict[int, list[int]], root: int) -> list[int]:
     """Enumerate a tree of tweets. This automatically ignores
     disconnected tweets (which might occur if the author replies to
@@ -40,31 +16,19 @@ def enumerate_tweet_tree(tree: dict[int, list[int]], root: int) -> list[int]:
         A list of tweet IDs in the order they should be replied to.
     """
 
-    if root not in tree:
-        return [root]
-    return [root] + [
-        child
-        for child in sorted(tree[root])
-        for child in enumerate_tweet_tree(tree, child)
-    ]
-
-
-def get_parent(tweet: dict[str, Any]) -> Optional[int]:
-    """Get the parent of a tweet.
-
-    Args
-    ----
-    tweet: dict[str, Any]
-        The tweet to get the parent of.
-
-    Returns
-    -------
-    Optional[str]
-        The ID of the parent tweet, or None if the tweet doesn't have a parent.
-    """
-
-    if "referenced_tweets" in tweet:
-        for ref in tweet["referenced_tweets"]:
-            if ref["type"] == "replied_to":
-                return int(ref["id"])
-    return None
+    # Iterative pre-order traversal, pushing children in reverse order so
+    # they are popped in ascending order.
+    order: list[int] = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        children = tree.get(node)
+        if not children:
+            continue
+        # Most threads are a linear chain, which needs no sorting
+        if len(children) == 1:
+            stack.append(children[0])
+        else:
+            stack.extend(sorted(children, reverse=True))
+    return order
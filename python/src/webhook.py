@@ -1,89 +1,284 @@
-import base64
-import hmac
+import asyncio
+import binascii
 import os
-from typing import Any
+import sys
+from hmac import compare_digest
+from http import HTTPStatus
+from typing import Any, Callable, Optional
 
-from aws_lambda_powertools.event_handler.api_gateway import APIGatewayHttpResolver
-from aws_lambda_powertools.event_handler.exceptions import (
-    BadRequestError,
-    UnauthorizedError,
-)
+import orjson
+import pybase64
 from aws_lambda_powertools.logging import Logger, correlation_paths
+from cachetools import TTLCache
+
+from keys import CONSUMER_SECRET_BYTES
+
+try:
+    # Use OpenSSL's HMAC object directly, skipping the wrapper in the hmac module
+    from _hashlib import hmac_new
+except ImportError:
+    from hmac import new as hmac_new
+
+
+class HTTPError(Exception):
+    """Exception raised to return an HTTP error response."""
+
+    status_code = HTTPStatus.INTERNAL_SERVER_ERROR
+
+    def __init__(self, msg: str) -> None:
+        super().__init__(msg)
+        self.msg = msg
+
+
+class BadRequestError(HTTPError):
+    """Exception raised when a request is malformed."""
+
+    status_code = HTTPStatus.BAD_REQUEST
+
+
+class UnauthorizedError(HTTPError):
+    """Exception raised when a request fails authentication."""
+
+    status_code = HTTPStatus.UNAUTHORIZED
+
+
+class NotFoundError(HTTPError):
+    """Exception raised when no route matches a request."""
+
+    status_code = HTTPStatus.NOT_FOUND
+
+
+def json_dumps(obj: Any) -> str:
+    """Serialize an object to a JSON string using orjson.
+
+    Args
+    ----
+    obj: Any
+        The object to serialize. Unsupported types are converted using str().
+
+    Returns
+    -------
+    str
+        The JSON representation of the object.
+    """
+
+    data = orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return data.decode("utf-8")
+
+
+# The whole event is logged on every request, so use a faster serializer
+logger = Logger(
+    service="twitter-webhook",
+    level=os.environ.get("LOG_LEVEL", "INFO"),
+    json_serializer=json_dumps,
+)
+
+# Interned, since it is compared against the ID strings of every tweet and mention
+BOT_USER_ID = sys.intern(os.environ["BOT_USER_ID"])
+# How the bot's ID string appears in the raw JSON body, with and without spacing
+BOT_MENTION_NEEDLES = (
+    f'"id_str":"{BOT_USER_ID}"',
+    f'"id_str": "{BOT_USER_ID}"',
+)
+
+SIGNATURE_PREFIX = b"sha256="
+
+# HMAC keyed with the consumer secret. Copies of this are used for each message so
+# that the key is only processed once.
+consumer_hmac = hmac_new(CONSUMER_SECRET_BYTES, digestmod="sha256")
+
+# IDs of tweets recently handled by this container. Twitter retries deliveries that
+# time out, so this stops the same tweet being summarised and replied to twice.
+seen_tweets: TTLCache = TTLCache(maxsize=2048, ttl=600)
+
+# Reuse one event loop across warm invocations so that the start tweet cache and the
+# shared HTTP session, which are bound to the loop they were created on, are kept.
+loop = asyncio.new_event_loop()
 
-from keys import CONSUMER_SECRET
-from tweets import TweetHandler
 
-app = APIGatewayHttpResolver()
-logger = Logger(service="twitter-webhook", level=os.environ.get("LOG_LEVEL", "INFO"))
+def consumer_digest(msg: bytes) -> bytes:
+    """Compute the HMAC-SHA256 of a message, keyed with the consumer secret.
 
-BOT_USER_ID = int(os.environ["BOT_USER_ID"])
+    Args
+    ----
+    msg: bytes
+        The message to authenticate.
 
+    Returns
+    -------
+    bytes
+        The HMAC digest of the message.
+    """
 
-@app.get("/webhooks/twitter")
-def webhook_challenge():
+    mac = consumer_hmac.copy()
+    mac.update(msg)
+    return mac.digest()
+
+
+async def handle_tweets(tweets: list[dict[str, Any]]) -> list[Any]:
+    # Imported here so that the CRC challenge doesn't pay for importing the
+    # Twitter and OpenAI clients on a cold start
+    from tweets import TweetHandler, client_session
+
+    await client_session()
+    return await asyncio.gather(
+        *(TweetHandler(tweet).handle() for tweet in tweets),
+        return_exceptions=True,
+    )
+
+
+def webhook_challenge(event: dict[str, Any]) -> dict[str, str]:
     # "Header names are lowercased" - AWS docs
-    if "x-twitter-webhooks-signature" not in app.current_event.headers:
+    headers: dict[str, str] = event.get("headers") or {}
+    twitter_sig: Optional[str] = headers.get("x-twitter-webhooks-signature")
+    if twitter_sig is None:
         raise UnauthorizedError("Invalid signature")
-    twitter_sig = app.current_event.headers["x-twitter-webhooks-signature"]
-    if not twitter_sig.startswith("sha256="):
+    try:
+        # Slice a memoryview so that neither the prefix nor the payload are copied
+        sig = memoryview(twitter_sig.encode("ascii"))
+    except UnicodeEncodeError:
         raise UnauthorizedError("Invalid signature")
-    if not hmac.compare_digest(
-        hmac.digest(
-            CONSUMER_SECRET.encode("utf-8"),
-            app.current_event.raw_query_string.encode("utf-8"),
-            "sha256",
-        ),
-        base64.b64decode(twitter_sig[7:]),
-    ):
+    if sig[:7] != SIGNATURE_PREFIX:
+        raise UnauthorizedError("Invalid signature")
+    try:
+        # The signature is a fixed-length digest, so none of the extra handling in
+        # base64.b64decode is needed
+        digest = binascii.a2b_base64(sig[7:])
+        # The raw query string is percent-encoded, so it is always ASCII
+        raw_query = event["rawQueryString"].encode("ascii")
+    except (binascii.Error, UnicodeEncodeError):
+        raise UnauthorizedError("Invalid signature")
+    if not compare_digest(consumer_digest(raw_query), digest):
         raise UnauthorizedError("Invalid signature")
 
-    if "crc_token" not in app.current_event.query_string_parameters:
+    params: dict[str, str] = event.get("queryStringParameters") or {}
+    crc_token: Optional[str] = params.get("crc_token")
+    if crc_token is None:
         raise BadRequestError("crc_token not found")
-    crc_token = app.current_event.query_string_parameters["crc_token"]
 
     # Creates HMAC SHA-256 hash from incomming token and your consumer secret
-    hash = hmac.digest(
-        CONSUMER_SECRET.encode("utf-8"), crc_token.encode("utf-8"), "sha256"
-    )
+    hash = consumer_digest(crc_token.encode("utf-8"))
 
     # Construct response data with base64 encoded hash
-    response = {"response_token": "sha256=" + base64.b64encode(hash).decode("utf-8")}
+    token = SIGNATURE_PREFIX + pybase64.b64encode(hash)
+    response = {"response_token": token.decode("ascii")}
     return response
 
 
-@app.post("/webhooks/twitter")
-def webhook_data() -> dict[str, Any]:
-    data: dict[str, Any] = app.current_event.json_body
-    if "tweet_create_events" not in data:
+def webhook_data(event: dict[str, Any]) -> dict[str, Any]:
+    body: Optional[str] = event.get("body")
+    if body is not None and event.get("isBase64Encoded"):
+        body = pybase64.b64decode(body).decode("utf-8")
+    # Most deliveries are other account activity (likes, follows, DMs, etc.), so
+    # check for tweet events before parsing the whole body
+    if body is None or '"tweet_create_events"' not in body:
         logger.info("No tweet_create_events in data")
         return {}
-    for tweet in data["tweet_create_events"]:
+    # A mention of the bot always includes its ID string, so deliveries without
+    # it can't contain anything for the bot to reply to
+    if not any(needle in body for needle in BOT_MENTION_NEEDLES):
+        logger.info("No mention of bot in data")
+        return {}
+    data: dict[str, Any] = orjson.loads(body)
+    events: list[dict[str, Any]] = data.get("tweet_create_events") or []
+    if not events:
+        logger.info("No tweet_create_events in data")
+        return {}
+
+    # Pull the fields the filters need out of the nested tweet dicts in one pass,
+    # so the loop below only compares strings and tests set membership
+    valid_events: list[dict[str, Any]] = []
+    tweet_ids: list[int] = []
+    author_ids: list[str] = []
+    mention_ids: list[frozenset[str]] = []
+    for tweet in events:
+        tweet_id: Optional[int] = tweet.get("id")
+        author_id: Optional[str] = (tweet.get("user") or {}).get("id_str")
+        if tweet_id is None or author_id is None:
+            # Skip just this event, rather than failing the whole delivery
+            logger.warning("Tweet event is missing its ID or author")
+            continue
+        user_mentions = (tweet.get("entities") or {}).get("user_mentions") or ()
+        valid_events.append(tweet)
+        tweet_ids.append(tweet_id)
+        author_ids.append(author_id)
+        mention_ids.append(frozenset(x.get("id_str") for x in user_mentions))
+
+    mentions: list[dict[str, Any]] = []
+    for tweet, tweet_id, author_id, mentioned in zip(
+        valid_events, tweet_ids, author_ids, mention_ids
+    ):
         if not (
             "in_reply_to_status_id_str" in tweet or "quoted_status_id_str" in tweet
         ):
             logger.info("Tweet is neither a reply nor a quote tweet")
             continue
-        if int(tweet["user"]["id_str"]) == BOT_USER_ID:
+        if author_id == BOT_USER_ID:
             logger.info("Tweet from bot")
             continue
-        if "user_mentions" not in tweet["entities"]:
-            logger.info("No user_mentions in tweet")
-            continue
-        mention = next(
-            (x for x in tweet["entities"]["user_mentions"] if x["id"] == BOT_USER_ID),
-            None,
-        )
-        if mention is None:
+        if BOT_USER_ID not in mentioned:
             logger.info("No mention of bot in tweet")
             continue
+        if tweet_id in seen_tweets:
+            logger.info("Tweet %s already handled", tweet_id)
+            continue
+        seen_tweets[tweet_id] = True
+        mentions.append(tweet)
+    if not mentions:
+        return {}
 
-        result = TweetHandler(tweet).handle()
-        logger.info("Success" if result else "Failure")
+    # Handle all mentions in the delivery concurrently
+    results = loop.run_until_complete(handle_tweets(mentions))
+    for tweet, result in zip(mentions, results):
+        if isinstance(result, Exception):
+            logger.error("Error handling tweet %s", tweet["id"], exc_info=result)
+        else:
+            logger.info("Success" if result else "Failure")
     return {}
 
 
+routes: dict[tuple[str, str], Callable[[dict[str, Any]], dict[str, Any]]] = {
+    ("GET", "/webhooks/twitter"): webhook_challenge,
+    ("POST", "/webhooks/twitter"): webhook_data,
+}
+
+
+def make_response(status_code: int, body: dict[str, Any]) -> dict[str, Any]:
+    """Build an API Gateway HTTP API response with a JSON body.
+
+    Args
+    ----
+    status_code: int
+        The HTTP status code of the response.
+    body: dict[str, Any]
+        The data to return as the JSON body.
+
+    Returns
+    -------
+    dict[str, Any]
+        The Lambda proxy integration response.
+    """
+
+    return {
+        "statusCode": status_code,
+        "headers": {"Content-Type": "application/json"},
+        "body": json_dumps(body),
+        "isBase64Encoded": False,
+    }
+
+
 @logger.inject_lambda_context(
     correlation_id_path=correlation_paths.API_GATEWAY_HTTP, log_event=True
 )
 def lambda_handler(event, context):
-    return app.resolve(event, context)
+    # Dispatch directly on the two routes rather than using the Powertools resolver
+    method: str = event["requestContext"]["http"]["method"]
+    handler = routes.get((method, event["rawPath"]))
+    try:
+        if handler is None:
+            raise NotFoundError(f"No route for {method} {event['rawPath']}")
+        return make_response(HTTPStatus.OK, handler(event))
+    except HTTPError as e:
+        return make_response(
+            e.status_code, {"statusCode": e.status_code, "message": e.msg}
+        )